@@ -22,6 +22,9 @@ def main():
     parser.add_argument('--csv_path',
                         action='store',
                         help='path for the csv file')
+    parser.add_argument('--fast_parse',
+                        action='store_true',
+                        help='split csv lines on the first comma, only for files without quoted values')
     parser.add_argument('--debug',
                         action='store_true',
                         help='set debug mode on, default is false')
@@ -42,7 +45,7 @@ def main():
     if args.mode == 'desccopy':
         description_manager.copy_field_descriptions(args.source, args.target)
     elif args.mode == 'descupload':
-        description_manager.upload_field_descriptions(args.csv_path, args.target)
+        description_manager.upload_field_descriptions(args.csv_path, args.target, args.fast_parse)
 
 
 if __name__ == '__main__':
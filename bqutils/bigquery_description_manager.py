@@ -3,10 +3,35 @@ Utility to manage BigQuery fields descriptions.
 """
 import csv
 import logging
+import operator
 import pprint
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from threading import RLock
 
+from cachetools import TTLCache, cachedmethod, keys
 from google.cloud import bigquery
 
+logger = logging.getLogger(__name__)
+
+TABLE_CACHE_SIZE = 1024
+TABLE_CACHE_TTL = 300
+CSV_BUFFER_SIZE = 1 << 20
+MAX_WORKERS = 16
+
+
+@lru_cache(maxsize=4096)
+def _qname(parent, child):
+    """
+    Returns the fully-qualified name of a field.
+    :param str parent: fully-qualified name of the parent field, empty for top-level fields
+    :param str child: name of the field
+    :return str: fully-qualified field name
+    """
+    return '{}.{}'.format(parent, child) if parent else child
+
 
 class BigQueryDescriptionManager:
     """
@@ -19,6 +44,8 @@ class BigQueryDescriptionManager:
         :param `google.cloud.bigquery.Client` bq_client: BigQuery client
         """
         self.bq_client = bq_client
+        self._table_cache = TTLCache(maxsize=TABLE_CACHE_SIZE, ttl=TABLE_CACHE_TTL)
+        self._cache_lock = RLock()
 
     def copy_field_descriptions(self, source_full_table_id, target_full_table_id):
         """
@@ -26,11 +53,30 @@ class BigQueryDescriptionManager:
         :param str source_full_table_id: fully-qualified source table ID
         :param str target_full_table_id: fully-qualified target table ID
         """
-        source_table = self.bq_client.get_table(source_full_table_id)
-        descriptions = self._get_descriptions_from_schema(source_table.schema)
-        logging.debug('Source descriptions processed.')
-        logging.debug('Source descriptions: %s', pprint.pformat(descriptions))
-        self.update_table_descriptions(target_full_table_id, descriptions)
+        if target_full_table_id == source_full_table_id:
+            source_table = target_table = self._get_table_uncached(source_full_table_id)
+        else:
+            # the two lookups are independent, so their round-trips can overlap
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                source_future = executor.submit(self._get_table_cached, source_full_table_id)
+                target_future = executor.submit(self._get_table_uncached, target_full_table_id)
+                source_table, target_table = source_future.result(), target_future.result()
+        descriptions = self._get_source_descriptions(source_table)
+        self._update_table(target_full_table_id, descriptions, target_table)
+
+    def copy_field_descriptions_batch(self, source_full_table_id, target_full_table_ids, max_workers=MAX_WORKERS):
+        """
+        Copy field descriptions from one table/view to several others, updating the targets in parallel.
+        :param str source_full_table_id: fully-qualified source table ID
+        :param list of str target_full_table_ids: fully-qualified target table IDs
+        :param int max_workers: maximum number of concurrent table updates
+        """
+        source_table = self._get_table_cached(source_full_table_id)
+        descriptions = self._get_source_descriptions(source_table)
+        # each table is updated once, concurrent updates of the same table would race
+        updates = [(target_full_table_id, descriptions)
+                   for target_full_table_id in dict.fromkeys(target_full_table_ids)]
+        self._update_tables(max_workers, updates)
 
     def update_table_descriptions(self, target_full_table_id, descriptions):
         """
@@ -38,41 +84,143 @@ class BigQueryDescriptionManager:
         :param str target_full_table_id: fully-qualified target table ID
         :param dict descriptions: dictionary of fully-qualified  field name and description pairs
         """
-        target_table = self.bq_client.get_table(target_full_table_id)
-        target_table.schema = self._get_new_schema(target_table.schema, descriptions)
-        logging.debug('Updating target table...')
-        self.bq_client.update_table(target_table, ['schema'])
-        logging.debug('Successful update')
+        self._update_table(target_full_table_id, descriptions)
+
+    def _update_table(self, target_full_table_id, descriptions, target_table=None):
+        """
+        Updates table with field descriptions, fetching the table only if it is not provided.
+        :param str target_full_table_id: fully-qualified target table ID
+        :param dict descriptions: dictionary of fully-qualified  field name and description pairs
+        :param `google.cloud.bigquery.Table` target_table: freshly loaded target table (optional)
+        """
+        if target_table is None:
+            # targets are never served from the cache, a stale etag would make the update fail
+            target_table = self._get_table_uncached(target_full_table_id)
+        if not self._needs_update(target_table.schema, descriptions):
+            logger.debug('No description changes, skipping update')
+            return
+        # a cached source lookup of the same table is outdated once the update starts, and one
+        # made while the update is running could still see the old schema
+        self._invalidate_cached_table(target_full_table_id)
+        try:
+            target_table.schema = self._get_new_schema(target_table.schema, descriptions)
+            logger.debug('Updating target table...')
+            self.bq_client.update_table(target_table, ['schema'])
+            logger.debug('Successful update')
+        finally:
+            self._invalidate_cached_table(target_full_table_id)
+
+    def _update_tables(self, max_workers, updates):
+        """
+        Runs several table updates in parallel.
+        :param int max_workers: maximum number of concurrent table updates
+        :param iterable of tuple updates: argument tuples for `_update_table`
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._update_table, *update) for update in updates]
+            for future in futures:
+                future.result()
+
+    def _invalidate_cached_table(self, table_id):
+        """
+        Drops the cached lookup of a table, if any.
+        :param str table_id: fully-qualified table ID
+        """
+        with self._cache_lock:
+            self._table_cache.pop(keys.hashkey(table_id), None)
+
+    def _get_table_uncached(self, table_id):
+        """
+        Fetches table/view metadata from BigQuery.
+        :param str table_id: fully-qualified table ID
+        :return `google.cloud.bigquery.Table`: table
+        """
+        return self.bq_client.get_table(table_id)
+
+    @cachedmethod(operator.attrgetter('_table_cache'), lock=operator.attrgetter('_cache_lock'))
+    def _get_table_cached(self, table_id):
+        """
+        Fetches table/view metadata, reusing recent lookups of the same table.
+        :param str table_id: fully-qualified table ID
+        :return `google.cloud.bigquery.Table`: table
+        """
+        return self._get_table_uncached(table_id)
+
+    def _get_source_descriptions(self, source_table):
+        """
+        Returns the field descriptions of the source table/view.
+        :param `google.cloud.bigquery.Table` source_table: source table
+        :return dict: dictionary of fully-qualified  field name and description pairs
+        """
+        descriptions = self._get_descriptions_from_schema(source_table.schema)
+        logger.debug('Source descriptions processed.')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Source descriptions: %s', pprint.pformat(descriptions))
+        return descriptions
 
     def _get_descriptions_from_schema(self, schema):
         """
-        Returns a dictionary of fully-qualified field names and descriptions.
+        Returns a dictionary of fully-qualified field names and descriptions, leaving out fields without one.
         :param list of `google.cloud.bigquery.schema.SchemaField` schema: table schema
         :return dict: dictionary of fully-qualified  field name and description pairs
         """
-        fields_to_process = [(column.name, column) for column in schema]
         descriptions = {}
-        while fields_to_process:
-            field = fields_to_process.pop()
-            descriptions[field[0]] = field[1].description
-            fields_to_process += [('{}.{}'.format(field[0], nested_field.name), nested_field)
-                                  for nested_field in field[1].fields]
+
+        def walk(prefix, fields):
+            for field in fields:
+                name = _qname(prefix, field.name)
+                if field.description:
+                    descriptions[name] = field.description
+                if field.fields:
+                    walk(name, field.fields)
+
+        walk('', schema)
         return descriptions
 
-    def _update_field(self, field, name, descriptions):
+    def _needs_update(self, schema, descriptions, prefix=''):
         """
-        Updates the current field and all of its nested fields with the appropriate descriptions.
-        :param dict field: dictionary representation of a SchemaField
+        Checks whether any field of the schema would get a different description.
+        :param list of `google.cloud.bigquery.schema.SchemaField` schema: table schema or nested fields
+        :param dict descriptions: dictionary of fully-qualified field names and descriptions
+        :param str prefix: fully-qualified name of the parent field, empty for the table schema
+        :return bool: True if at least one description differs
+        """
+        for field in schema:
+            name = _qname(prefix, field.name)
+            description = descriptions.get(name)
+            if description and description != field.description:
+                return True
+            if field.fields and self._needs_update(field.fields, descriptions, name):
+                return True
+        return False
+
+    def _get_new_field(self, field, name, descriptions, prefixes):
+        """
+        Creates a copy of the field and all of its nested fields with the appropriate descriptions.
+        :param `google.cloud.bigquery.schema.SchemaField` field: original field
         :param str name: fully-qualified field name
         :param dict descriptions: dictionary of fully-qualified field names and descriptions
-        :return:
+        :param set prefixes: fully-qualified names of the fields with nested descriptions
+        :return `google.cloud.bigquery.schema.SchemaField`: updated field
         """
-        if name in descriptions and descriptions[name]:
-            field['description'] = descriptions[name]
-        if 'fields' in field:
-            for nested_field in field['fields']:
-                self._update_field(nested_field,
-                                   '{}.{}'.format(name, nested_field['name']), descriptions)
+        description = descriptions.get(name) or field.description
+        if name not in prefixes and description == field.description:
+            # nothing changes in this subtree, the original field can be shared
+            return field
+        # going through the api representation keeps properties like policy tags or precision
+        api_repr = dict(field.to_api_repr())
+        if description != field.description:
+            api_repr['description'] = description
+        if name in prefixes:
+            nested_api_reprs = []
+            for nested_field, nested_api_repr in zip(field.fields, api_repr.get('fields', ())):
+                new_nested_field = self._get_new_field(nested_field, _qname(name, nested_field.name),
+                                                       descriptions, prefixes)
+                # unchanged subtrees keep the representation serialized along with the parent
+                nested_api_reprs.append(nested_api_repr if new_nested_field is nested_field
+                                        else new_nested_field.to_api_repr())
+            api_repr['fields'] = nested_api_reprs
+        return bigquery.schema.SchemaField.from_api_repr(api_repr)
 
     def _get_new_schema(self, schema, descriptions):
         """
@@ -81,19 +229,59 @@ class BigQueryDescriptionManager:
         :param dict descriptions: dictionary of fully-qualified  field names and descriptions
         :return list of `google.cloud.bigquery.schema.SchemaField`: updated table schema
         """
-        temp_schema = [field.to_api_repr() for field in schema]
-        for field in temp_schema:
-            self._update_field(field, field['name'], descriptions)
-        updated_schema = [bigquery.schema.SchemaField.from_api_repr(field) for field in temp_schema]
-        return updated_schema
+        prefixes = set()
+        for name in descriptions:
+            position = name.rfind('.')
+            # once a prefix is known, all of its ancestors are known as well
+            while position > 0 and name[:position] not in prefixes:
+                prefixes.add(name[:position])
+                position = name.rfind('.', 0, position)
+        return [self._get_new_field(field, field.name, descriptions, prefixes) for field in schema]
+
+    def _read_descriptions(self, csv_path, fast_parse=False):
+        """
+        Reads fully-qualified field names and descriptions from a csv file, skipping empty descriptions.
+        :param str csv_path: path to the csv file (header row should be emitted)
+        :param bool fast_parse: split lines on the first comma instead of using the csv module,
+            only for files without quoted values
+        :return generator of tuple: fully-qualified field name and description pairs
+        """
+        with open(csv_path, newline='', buffering=CSV_BUFFER_SIZE) as input_file:
+            if fast_parse:
+                for line in input_file:
+                    name, _, description = line.rstrip('\r\n').partition(',')
+                    if description:
+                        yield sys.intern(name), sys.intern(description)
+            else:
+                for row in csv.reader(input_file):
+                    if len(row) >= 2 and row[1]:
+                        # repeated names and boilerplate descriptions share a single string object
+                        yield sys.intern(row[0]), sys.intern(row[1])
 
-    def upload_field_descriptions(self, csv_path, target_full_table_id):
+    def upload_field_descriptions(self, csv_path, target_full_table_id, fast_parse=False):
         """
         Uploads field descriptions from a csv file to a table/view.
         :param str csv_path: path to the csv file (header row should be emitted)
         :param str target_full_table_id: fully-qualified target table ID
+        :param bool fast_parse: split lines on the first comma, only for files without quoted values
+        """
+        descriptions = dict(self._read_descriptions(csv_path, fast_parse))
+        self.update_table_descriptions(target_full_table_id, descriptions)
+
+    def upload_field_descriptions_multi(self, csv_path, project, max_workers=MAX_WORKERS, fast_parse=False):
+        """
+        Uploads field descriptions from a csv file to several tables/views of a project in parallel.
+        :param str csv_path: path to the csv file with `dataset.table.field` names (header row should be emitted)
+        :param str project: project ID of the target tables
+        :param int max_workers: maximum number of concurrent table updates
+        :param bool fast_parse: split lines on the first comma, only for files without quoted values
         """
-        with open(csv_path) as input_file:
-            csv_reader = csv.reader(input_file)
-            descriptions = {row[0]: row[1] for row in csv_reader}
-            self.update_table_descriptions(target_full_table_id, descriptions)
+        descriptions_by_table = defaultdict(dict)
+        for name, description in self._read_descriptions(csv_path, fast_parse):
+            parts = name.split('.', 2)
+            if len(parts) < 3:
+                raise ValueError('Field name {} is not in dataset.table.field format'.format(name))
+            dataset_id, table_id, field_name = parts
+            target_full_table_id = '{}.{}.{}'.format(project, dataset_id, table_id)
+            descriptions_by_table[target_full_table_id][sys.intern(field_name)] = description
+        self._update_tables(max_workers, descriptions_by_table.items())
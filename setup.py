@@ -22,7 +22,7 @@ setup(
     ],
     packages=["bqutils"],
     include_package_data=True,
-    install_requires=["google-cloud-bigquery"],
+    install_requires=["cachetools", "google-cloud-bigquery"],
     entry_points={
         "console_scripts": [
             "bqutils=bqutils.__main__:main",
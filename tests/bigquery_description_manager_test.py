@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 from unittest import mock
 
@@ -9,6 +11,7 @@ from bqutils.bigquery_description_manager import BigQueryDescriptionManager
 class DescriptionManagerTestCase(unittest.TestCase):
     source_table_id = 'project_name.dataset_name.source_table'
     target_table_id = 'other_project_name.other_dataset_name.target_table'
+    second_target_table_id = 'other_project_name.other_dataset_name.second_target_table'
 
     def patched_get_table(self, table_id):
         if table_id == self.source_table_id:
@@ -41,6 +44,14 @@ class DescriptionManagerTestCase(unittest.TestCase):
                                              fields=[bigquery.SchemaField('hits', 'INTEGER', 'NULLABLE'),
                                                      bigquery.SchemaField('pageviews', 'INTEGER', 'NULLABLE')])
                         ])
+        elif table_id == self.second_target_table_id:
+            return bigquery.Table(
+                bigquery.TableReference(bigquery.DatasetReference('other_project_name', 'other_dataset_name'),
+                                        'second_target_table'),
+                schema=[bigquery.SchemaField('visitNumber', 'STRING', 'NULLABLE'),
+                        bigquery.SchemaField('totals', 'RECORD', 'NULLABLE',
+                                             fields=[bigquery.SchemaField('screenviews', 'INTEGER', 'NULLABLE')])
+                        ])
 
     def test_get_descriptions(self):
         mock_bq_client = mock.create_autospec(bigquery.Client, instance=True)
@@ -71,3 +82,198 @@ class DescriptionManagerTestCase(unittest.TestCase):
                                                                       'Total number of pageviews within the session.')])
                            ]
         self.assertListEqual(table_arg.schema, expected_schema)
+
+    def test_source_table_is_cached(self):
+        mock_bq_client = mock.create_autospec(bigquery.Client, instance=True)
+        reference = BigQueryDescriptionManager(mock_bq_client)
+        mock_bq_client.get_table.side_effect = self.patched_get_table
+        reference.copy_field_descriptions(self.source_table_id, self.target_table_id)
+        reference.copy_field_descriptions(self.source_table_id, self.target_table_id)
+        fetched_ids = [call[0][0] for call in mock_bq_client.get_table.call_args_list]
+        self.assertEqual(fetched_ids.count(self.source_table_id), 1)
+        self.assertEqual(fetched_ids.count(self.target_table_id), 2)
+        self.assertEqual(mock_bq_client.update_table.call_count, 2)
+
+    def test_upload_field_descriptions(self):
+        mock_bq_client = mock.create_autospec(bigquery.Client, instance=True)
+        reference = BigQueryDescriptionManager(mock_bq_client)
+        mock_bq_client.get_table = self.patched_get_table
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as csv_file:
+            csv_file.write('clientId,"Client ID, unhashed."\n'
+                           'fullVisitorId,\n'
+                           'totals.hits,Total number of hits within the session.\n'
+                           'visitNumber\n')
+        try:
+            reference.upload_field_descriptions(csv_file.name, self.target_table_id)
+        finally:
+            os.remove(csv_file.name)
+        table_arg = mock_bq_client.update_table.call_args[0][0]
+        expected_schema = [bigquery.SchemaField('clientId', 'STRING', 'NULLABLE', 'Client ID, unhashed.'),
+                           bigquery.SchemaField('fullVisitorId', 'STRING', 'NULLABLE'),
+                           bigquery.SchemaField('totals', 'RECORD', 'NULLABLE',
+                                                fields=[bigquery.SchemaField('hits', 'INTEGER', 'NULLABLE',
+                                                                             'Total number of hits within the session.'),
+                                                        bigquery.SchemaField('pageviews', 'INTEGER', 'NULLABLE')])
+                           ]
+        self.assertListEqual(table_arg.schema, expected_schema)
+
+    def test_copy_field_descriptions_batch(self):
+        mock_bq_client = mock.create_autospec(bigquery.Client, instance=True)
+        reference = BigQueryDescriptionManager(mock_bq_client)
+        mock_bq_client.get_table.side_effect = self.patched_get_table
+        reference.copy_field_descriptions_batch(self.source_table_id,
+                                                [self.target_table_id, self.second_target_table_id,
+                                                 self.target_table_id])
+        fetched_ids = [call[0][0] for call in mock_bq_client.get_table.call_args_list]
+        self.assertEqual(fetched_ids.count(self.source_table_id), 1)
+        self.assertEqual(mock_bq_client.update_table.call_count, 2)
+        schemas = {call[0][0].table_id: call[0][0].schema for call in mock_bq_client.update_table.call_args_list}
+        self.assertListEqual(schemas['target_table'], [
+            bigquery.SchemaField('clientId', 'STRING', 'NULLABLE',
+                                 'Unhashed version of the Client ID for a'
+                                 ' given user associated with any given visit/session.'),
+            bigquery.SchemaField('fullVisitorId', 'STRING', 'NULLABLE',
+                                 'The unique visitor ID (also known as client ID).'),
+            bigquery.SchemaField('totals', 'RECORD', 'NULLABLE',
+                                 'This section contains aggregate values across the session.',
+                                 [bigquery.SchemaField('hits', 'INTEGER', 'NULLABLE',
+                                                       'Total number of hits within the session.'),
+                                  bigquery.SchemaField('pageviews', 'INTEGER', 'NULLABLE',
+                                                       'Total number of pageviews within the session.')])
+        ])
+        self.assertListEqual(schemas['second_target_table'], [
+            bigquery.SchemaField('visitNumber', 'STRING', 'NULLABLE',
+                                 'The session number for this user. '
+                                 'If this is the first session, then this is set to 1.'),
+            bigquery.SchemaField('totals', 'RECORD', 'NULLABLE',
+                                 'This section contains aggregate values across the session.',
+                                 [bigquery.SchemaField('screenviews', 'INTEGER', 'NULLABLE',
+                                                       'Total number of screenviews within the session.')])
+        ])
+
+    def test_unchanged_descriptions_skip_update(self):
+        mock_bq_client = mock.create_autospec(bigquery.Client, instance=True)
+        reference = BigQueryDescriptionManager(mock_bq_client)
+        mock_bq_client.get_table.side_effect = self.patched_get_table
+        reference.copy_field_descriptions(self.source_table_id, self.target_table_id)
+        updated_table = mock_bq_client.update_table.call_args[0][0]
+
+        # the target already carries every source description
+        mock_bq_client.get_table.side_effect = lambda table_id: (
+            updated_table if table_id == self.target_table_id else self.patched_get_table(table_id))
+        reference.copy_field_descriptions(self.source_table_id, self.target_table_id)
+        self.assertEqual(mock_bq_client.update_table.call_count, 1)
+
+        # a single nested description is out of date
+        totals = updated_table.schema[2]
+        stale_table = bigquery.Table(updated_table.reference, schema=updated_table.schema[:2] + [
+            bigquery.SchemaField('totals', 'RECORD', 'NULLABLE', totals.description,
+                                 [bigquery.SchemaField('hits', 'INTEGER', 'NULLABLE', 'Outdated description.'),
+                                  totals.fields[1]])])
+        mock_bq_client.get_table.side_effect = lambda table_id: (
+            stale_table if table_id == self.target_table_id else self.patched_get_table(table_id))
+        reference.copy_field_descriptions(self.source_table_id, self.target_table_id)
+        self.assertEqual(mock_bq_client.update_table.call_count, 2)
+        table_arg = mock_bq_client.update_table.call_args[0][0]
+        self.assertEqual(table_arg.schema, updated_table.schema)
+
+    def test_upload_field_descriptions_multi(self):
+        mock_bq_client = mock.create_autospec(bigquery.Client, instance=True)
+        reference = BigQueryDescriptionManager(mock_bq_client)
+        mock_bq_client.get_table.side_effect = self.patched_get_table
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as csv_file:
+            csv_file.write('other_dataset_name.target_table.clientId,Client ID.\n'
+                           'other_dataset_name.target_table.totals.hits,Total number of hits.\n'
+                           'dataset_name.source_table.clientId,\n')
+        try:
+            reference.upload_field_descriptions_multi(csv_file.name, 'other_project_name')
+        finally:
+            os.remove(csv_file.name)
+        mock_bq_client.get_table.assert_called_once_with(self.target_table_id)
+        table_arg = mock_bq_client.update_table.call_args[0][0]
+        self.assertEqual(table_arg.schema[0].description, 'Client ID.')
+        self.assertEqual(table_arg.schema[2].fields[0].description, 'Total number of hits.')
+
+    def test_upload_field_descriptions_fast_parse(self):
+        mock_bq_client = mock.create_autospec(bigquery.Client, instance=True)
+        reference = BigQueryDescriptionManager(mock_bq_client)
+        mock_bq_client.get_table = self.patched_get_table
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as csv_file:
+            csv_file.write('clientId,Client ID, unhashed.\r\n'
+                           'fullVisitorId,\r\n'
+                           'totals.hits,Total number of hits within the session.')
+        try:
+            reference.upload_field_descriptions(csv_file.name, self.target_table_id, fast_parse=True)
+        finally:
+            os.remove(csv_file.name)
+        table_arg = mock_bq_client.update_table.call_args[0][0]
+        self.assertEqual(table_arg.schema[0].description, 'Client ID, unhashed.')
+        self.assertIsNone(table_arg.schema[1].description)
+        self.assertEqual(table_arg.schema[2].fields[0].description, 'Total number of hits within the session.')
+
+    def test_target_table_is_not_served_from_cache(self):
+        mock_bq_client = mock.create_autospec(bigquery.Client, instance=True)
+        reference = BigQueryDescriptionManager(mock_bq_client)
+        mock_bq_client.get_table.side_effect = self.patched_get_table
+        reference.copy_field_descriptions(self.target_table_id, self.source_table_id)
+        reference.copy_field_descriptions(self.source_table_id, self.target_table_id)
+        fetched_ids = [call[0][0] for call in mock_bq_client.get_table.call_args_list]
+        self.assertEqual(fetched_ids.count(self.target_table_id), 2)
+        self.assertEqual(mock_bq_client.update_table.call_count, 1)
+
+    def test_unchanged_nested_fields_are_serialized_once(self):
+        reference = BigQueryDescriptionManager(mock.create_autospec(bigquery.Client, instance=True))
+        inner = bigquery.SchemaField('inner', 'RECORD', 'NULLABLE',
+                                     fields=[bigquery.SchemaField('x', 'STRING', 'NULLABLE')])
+        schema = [bigquery.SchemaField('r', 'RECORD', 'NULLABLE',
+                                       fields=[bigquery.SchemaField('c', 'STRING', 'NULLABLE'), inner])]
+        to_api_repr = bigquery.SchemaField.to_api_repr
+        with mock.patch.object(bigquery.SchemaField, 'to_api_repr', autospec=True,
+                               side_effect=to_api_repr) as mock_to_api_repr:
+            new_schema = reference._get_new_schema(schema, {'r.c': 'd'})
+        serialized_names = [call[0][0].name for call in mock_to_api_repr.call_args_list]
+        self.assertEqual(serialized_names.count('inner'), 1)
+        self.assertEqual(new_schema[0].fields[0].description, 'd')
+        self.assertEqual(new_schema[0].fields[1], inner)
+
+    def test_source_lookup_during_update_is_not_cached(self):
+        mock_bq_client = mock.create_autospec(bigquery.Client, instance=True)
+        reference = BigQueryDescriptionManager(mock_bq_client)
+        mock_bq_client.get_table.side_effect = self.patched_get_table
+        # a concurrent source lookup of the target while its update is in flight
+        mock_bq_client.update_table.side_effect = lambda table, fields: reference._get_table_cached(
+            self.target_table_id)
+        reference.copy_field_descriptions(self.source_table_id, self.target_table_id)
+        reference._get_table_cached(self.target_table_id)
+        fetched_ids = [call[0][0] for call in mock_bq_client.get_table.call_args_list]
+        self.assertEqual(fetched_ids.count(self.target_table_id), 3)
+
+    def test_needs_update(self):
+        reference = BigQueryDescriptionManager(mock.create_autospec(bigquery.Client, instance=True))
+        schema = [bigquery.SchemaField('clientId', 'STRING', 'NULLABLE', 'Client ID.'),
+                  bigquery.SchemaField('totals', 'RECORD', 'NULLABLE', 'Totals.',
+                                       [bigquery.SchemaField('hits', 'INTEGER', 'NULLABLE', 'Hits.')])]
+        self.assertTrue(reference._needs_update(schema, {'totals.hits': 'Total number of hits.'}))
+        self.assertFalse(reference._needs_update(schema, {'clientId': 'Client ID.', 'totals.hits': 'Hits.'}))
+        self.assertFalse(reference._needs_update(schema, {'hits': 'Hits elsewhere.',
+                                                          'totals.pageviews': 'Pageviews.',
+                                                          'visitNumber': 'Visit number.'}))
+
+    def test_untouched_fields_are_reused(self):
+        reference = BigQueryDescriptionManager(mock.create_autospec(bigquery.Client, instance=True))
+        schema = [bigquery.SchemaField('clientId', 'STRING', 'NULLABLE'),
+                  bigquery.SchemaField('fullVisitorId', 'STRING', 'NULLABLE', 'Visitor ID.'),
+                  bigquery.SchemaField('device', 'RECORD', 'NULLABLE',
+                                       fields=[bigquery.SchemaField('browser', 'STRING', 'NULLABLE')]),
+                  bigquery.SchemaField('totals', 'RECORD', 'NULLABLE',
+                                       fields=[bigquery.SchemaField('hits', 'INTEGER', 'NULLABLE'),
+                                               bigquery.SchemaField('pageviews', 'INTEGER', 'NULLABLE')])]
+        new_schema = reference._get_new_schema(schema, {'clientId': 'Client ID.',
+                                                        'fullVisitorId': 'Visitor ID.',
+                                                        'totals.hits': 'Hits.'})
+        self.assertEqual(new_schema[0].description, 'Client ID.')
+        self.assertIs(new_schema[1], schema[1])
+        self.assertIs(new_schema[2], schema[2])
+        self.assertIs(new_schema[2].fields[0], schema[2].fields[0])
+        self.assertEqual(new_schema[3].fields[0].description, 'Hits.')
+        self.assertEqual(new_schema[3].fields[1], schema[3].fields[1])